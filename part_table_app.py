@@ -1,10 +1,21 @@
 # multi_rack_fg_stock.py
 import streamlit as st
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.feather as feather
 from datetime import datetime
-import hashlib
+import hmac
 import io
 import math
+import os
+import tempfile
+import threading
+import uuid
+import bisect
+import itertools
+from collections import defaultdict, deque
 
 # ----------------------------
 # App config
@@ -14,20 +25,23 @@ st.set_page_config(page_title="Multi-Rack FG Stock Board", layout="wide")
 # ----------------------------
 # Demo authenticator (IN-APP demo only)
 # ----------------------------
+HASH_KEY = b"stockboard-demo"
+
+# Pre-hashed (HMAC-SHA-256 with HASH_KEY) so nothing is rehashed on every script rerun
 USERS = {
-    "Vishal": {"pw_hash": hashlib.sha256(b"master123").hexdigest(), "role": "master"},
-    "Kittu": {"pw_hash": hashlib.sha256(b"input123").hexdigest(), "role": "input"},
-    "1306764": {"pw_hash": hashlib.sha256(b"output123").hexdigest(), "role": "output"},
+    "Vishal": {"pw_hash": "1926c5db767327d2e44b28a9003cc9e04332aaa028112b1937406cc4012f25ab", "role": "master"},
+    "Kittu": {"pw_hash": "6218859f29231cc51e4e27e1561a11e9e523a41d2dd60ccf4f3a183d6de789bb", "role": "input"},
+    "1306764": {"pw_hash": "b958d6b1f862332d99646fc7225ea8a61aa6bd58f1b81b71190248e46c070a06", "role": "output"},
 }
 
 def hash_pw(pw: str) -> str:
-    return hashlib.sha256(pw.encode("utf-8")).hexdigest()
+    return hmac.new(HASH_KEY, pw.encode("utf-8"), "sha256").hexdigest()
 
 def login(username: str, password: str):
     u = USERS.get(username)
     if not u:
         return False, None
-    return (u["pw_hash"] == hash_pw(password)), u["role"]
+    return hmac.compare_digest(u["pw_hash"], hash_pw(password)), u["role"]
 
 # ----------------------------
 # Constants
@@ -36,49 +50,331 @@ PACKAGING_WEIGHT = 25.0  # kg per non-empty cell
 CELL_CAPACITY = 25       # pieces per cell
 RACK_SPACES = {"A": 9, "B": 15, "C": 12, "D": 6, "E": 24, "F": 57}
 FIXED_ROWS = 3
+CSV_CHUNK_ROWS = 10_000  # rows per to_csv call on exports
+HISTORY_MAXLEN = 10_000   # oldest events are dropped beyond this
+RACK_PAGE_CELLS = 20      # larger racks are shown a band of rows at a time
+HISTORY_DISPLAY_ROWS = 200  # most recent events shown unless "Show all" is ticked
+# Cell is "-" for master updates, so it is exported as text
+HISTORY_SCHEMA = pa.schema(
+    [
+        ("Timestamp", pa.string()),
+        ("User", pa.string()),
+        ("Action", pa.string()),
+        ("Rack", pa.string()),
+        ("Cell", pa.string()),
+        ("Part No", pa.string()),
+        ("Quantity", pa.int64()),
+        ("Note", pa.string()),
+    ]
+)
+# saved state lives next to the app unless STOCK_BOARD_DATA_DIR points elsewhere
+SNAPSHOT_DIR = os.environ.get("STOCK_BOARD_DATA_DIR") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "stock_data"
+)
+RACKS_SNAPSHOT = os.path.join(SNAPSHOT_DIR, "racks.npz")  # racks, part master, FIFO order, generation
+HISTORY_DIR = os.path.join(SNAPSHOT_DIR, "history")       # one LZ4 Arrow IPC file of new events per save
+HISTORY_COMPACT_SEGMENTS = 256  # history files kept before the log is rewritten as one
 
 # ----------------------------
-# Init session state
+# Persistence
 # ----------------------------
-if "logged_in" not in st.session_state:
-    st.session_state.logged_in = False
-    st.session_state.user = None
-    st.session_state.role = None
+# Every session writes through the same files. Each change is made under
+# snapshot_lock() on top of the latest saved state (sync_snapshot), so a
+# session that loaded earlier cannot overwrite what others saved since.
+@st.cache_resource(show_spinner=False)
+def snapshot_lock():
+    # sessions run on separate threads of one server process
+    return threading.Lock()
+
+def history_segment_path(generation):
+    return os.path.join(HISTORY_DIR, f"{generation:08d}.arrow")
+
+def atomic_write(path, write):
+    """
+    Write through a uniquely named temp file in the target directory, then
+    rename it over path so a reader never sees a half-written file.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+def snapshot_generation():
+    """
+    Generation of the saved state (bumped on every save), -1 if none yet.
+    """
+    if not os.path.exists(RACKS_SNAPSHOT):
+        return -1
+    with np.load(RACKS_SNAPSHOT) as npz:
+        return int(npz["generation"])
+
+@st.cache_data(max_entries=1)
+def load_snapshot(generation):
+    """
+    Read the saved state. The generation only keys the cache, so sessions
+    pick up a newer save; history is read newest file first, and only as
+    many files as HISTORY_MAXLEN needs. Raises FileNotFoundError if a
+    history file is gone, which is not cached.
+    """
+    with np.load(RACKS_SNAPSHOT) as npz:
+        arrays = {k: npz[k] for k in npz.files}
+    history = []
+    for g in range(int(arrays["generation"]), int(arrays["history_base"]) - 1, -1):
+        if len(history) >= HISTORY_MAXLEN:
+            break
+        history.extend(feather.read_table(history_segment_path(g)).to_pylist())
+    for ev in history:
+        # Cell is stored as text; stock events had an int cell number
+        if ev["Cell"].isdigit():
+            ev["Cell"] = int(ev["Cell"])
+    return arrays, history
+
+def history_table(n_events=None):
+    """
+    History as an Arrow table, built column-wise from the deque; n_events
+    limits it to the newest events.
+    """
+    history = list(itertools.islice(st.session_state.history, n_events))
+    cols = {name: [ev[name] for ev in history] for name in HISTORY_SCHEMA.names}
+    cols["Cell"] = [str(c) for c in cols["Cell"]]
+    return pa.Table.from_pydict(cols, schema=HISTORY_SCHEMA)
 
-if "part_master" not in st.session_state:
-    st.session_state.part_master = {
-        "10283026": {"Weight": 8.05, "Customer": "Mahindra Pune", "Tube Length": 1254},
-        "10291078": {"Weight": 7.90, "Customer": "Mahindra Pune", "Tube Length": 1245},
-        "10282069": {"Weight": 8.95, "Customer": "Mahindra Pune", "Tube Length": 1262},
+def save_snapshot():
+    """
+    Persist the session's stock state as the next generation: rack arrays
+    (int32 part ids, int16 quantities), the part master and FIFO order go to
+    one compressed .npz, and only the events added since the last save go
+    to a new history file. Call under snapshot_lock(), after sync_snapshot().
+    """
+    os.makedirs(HISTORY_DIR, exist_ok=True)
+    generation = st.session_state.snapshot_generation + 1
+    history_base = st.session_state.history_base
+    if generation - history_base >= HISTORY_COMPACT_SEGMENTS:
+        # rewrite the whole (bounded) log as one file, then drop the old ones
+        history_base = generation
+        events = history_table()
+    else:
+        events = history_table(st.session_state.history_unsaved)
+    atomic_write(history_segment_path(generation), lambda f: feather.write_feather(events, f, compression="lz4"))
+
+    pm = st.session_state.part_master_df
+    fifo = [(pn, rk, cn) for pn, q in st.session_state.fifo_index.items() for rk, cn in q]
+    arrays = {
+        "generation": np.int64(generation),
+        "history_base": np.int64(history_base),
+        "part_ids": pm.index.to_numpy(dtype=str),
+        "part_weight": pm["Weight"].to_numpy(),
+        "part_customer": pm["Customer"].to_numpy(dtype=str),
+        "part_tube": pm["Tube Length"].to_numpy(dtype=np.int64),
+        "fifo_part": np.array([f[0] for f in fifo], dtype=str),
+        "fifo_rack": np.array([f[1] for f in fifo], dtype=str),
+        "fifo_cell": np.array([f[2] for f in fifo], dtype=np.int64),
+    }
+    for r, rack in st.session_state.racks.items():
+        arrays[f"{r}_pid"] = rack["part_id"]
+        arrays[f"{r}_qty"] = rack["qty"].astype(np.int16)
+    # the .npz names the generation, so it goes last; a history file left
+    # by a failed save is never read and is overwritten by the next one
+    atomic_write(RACKS_SNAPSHOT, lambda f: np.savez_compressed(f, **arrays))
+    st.session_state.snapshot_generation = generation
+    st.session_state.history_base = history_base
+    st.session_state.history_unsaved = 0
+    if history_base == generation:
+        # files below history_base are never read, so a failed removal is
+        # left for the next compaction
+        for name in os.listdir(HISTORY_DIR):
+            if name.endswith(".arrow") and int(name[:-6]) < history_base:
+                try:
+                    os.remove(os.path.join(HISTORY_DIR, name))
+                except OSError:
+                    pass
+
+def save_change(message):
+    """
+    Save the change just applied to session state and return the notice to
+    show: ("success", message), or ("error", reason) when it cannot be
+    written, after reloading the last saved state to undo the change. Call
+    under snapshot_lock().
+    """
+    try:
+        save_snapshot()
+    except OSError as e:
+        st.session_state.snapshot_generation = None  # forces sync_snapshot to reload
+        sync_snapshot()
+        return ("error", f"Could not save the change, so it was not applied: {e}")
+    return ("success", message)
+
+def new_rack(spaces):
+    cols = math.ceil(spaces / FIXED_ROWS)
+    # cell_no (bottom-left = 1, left->right, bottom->top) <-> (row_idx, col_idx) lookup tables
+    cells = np.arange(1, spaces + 1, dtype=np.int32)
+    row_idx = FIXED_ROWS - 1 - (cells - 1) // cols
+    col_idx = (cells - 1) % cols
+    rows_from_bottom = FIXED_ROWS - 1 - np.arange(FIXED_ROWS, dtype=np.int32)
+    # struct-of-arrays: one array per field, array[0] is the top row
+    return {
+        "rows": FIXED_ROWS,
+        "cols": cols,
+        "spaces": spaces,
+        "part_id": np.full((FIXED_ROWS, cols), -1, dtype=np.int32),
+        "qty": np.zeros((FIXED_ROWS, cols), dtype=np.int32),
+        "cell_to_rc": np.stack([row_idx, col_idx], axis=1),
+        "rc_to_cell": rows_from_bottom[:, None] * cols + np.arange(cols, dtype=np.int32) + 1,
     }
 
-if "racks" not in st.session_state:
+def restore_state(snapshot, saved_history):
+    """
+    (Re)build the session's stock state from a loaded snapshot, or from the
+    default part master and empty racks when snapshot is None.
+    """
+    # st.cache_data is process-wide, so per-session caches are keyed on this;
+    # a new id on every (re)load also retires entries built from older state
+    st.session_state.session_id = uuid.uuid4().hex
+    st.session_state.snapshot_generation = int(snapshot["generation"]) if snapshot else -1
+    st.session_state.history_base = int(snapshot["history_base"]) if snapshot else 0
+
+    if snapshot:
+        part_nos = snapshot["part_ids"].astype(str)
+        columns = {
+            "Weight": snapshot["part_weight"],
+            "Customer": snapshot["part_customer"].astype(str),
+            "Tube Length": snapshot["part_tube"],
+        }
+    else:
+        part_nos = ["10283026", "10291078", "10282069"]
+        columns = {
+            "Weight": [8.05, 7.90, 8.95],
+            "Customer": ["Mahindra Pune", "Mahindra Pune", "Mahindra Pune"],
+            "Tube Length": [1254, 1245, 1262],
+        }
+    # rows stay in part id order; upserts only ever append
+    st.session_state.part_master_df = pd.DataFrame(
+        columns, index=pd.Index(part_nos, name="Part No")
+    ).astype({"Weight": "float64", "Customer": "str", "Tube Length": "int64"})
+    st.session_state.part_master_version = 0
+    st.session_state.sorted_parts = sorted(st.session_state.part_master_df.index)
+    # racks store small integer part ids (-1 = empty); these map them back
+    st.session_state.part_ids = list(st.session_state.part_master_df.index)
+    st.session_state.part_id = {pn: i for i, pn in enumerate(st.session_state.part_ids)}
+    st.session_state.part_weights = st.session_state.part_master_df["Weight"].to_numpy()
+
     racks = {}
+    restored_racks = set()
     for r, spaces in RACK_SPACES.items():
-        cols = math.ceil(spaces / FIXED_ROWS)
-        grid = [[{"Part No": None, "Quantity": 0} for _ in range(cols)] for _ in range(FIXED_ROWS)]
-        racks[r] = {"rows": FIXED_ROWS, "cols": cols, "array": grid, "spaces": spaces}
+        racks[r] = new_rack(spaces)
+        # skip a saved rack whose layout no longer matches RACK_SPACES
+        if snapshot and f"{r}_qty" in snapshot and snapshot[f"{r}_qty"].shape == racks[r]["qty"].shape:
+            racks[r]["part_id"][:] = snapshot[f"{r}_pid"]
+            racks[r]["qty"][:] = snapshot[f"{r}_qty"]
+            # same shape but fewer spaces: drop stock saved in cells past the end
+            beyond = racks[r]["rc_to_cell"] > spaces
+            racks[r]["part_id"][beyond] = -1
+            racks[r]["qty"][beyond] = 0
+            restored_racks.add(r)
     st.session_state.racks = racks
+    st.session_state.total_qty = int(sum(rack["qty"].sum() for rack in racks.values()))
+    st.session_state.rack_versions = {r: 0 for r in RACK_SPACES}
+    st.session_state.state_version = 0  # bumped on any stock change
+
+    # saved history is newest first; a bounded deque fed directly would keep the oldest
+    st.session_state.history = deque(itertools.islice(saved_history, HISTORY_MAXLEN), maxlen=HISTORY_MAXLEN)
+    # bumped per event; len(history) stops changing once the deque is full
+    st.session_state.history_version = 0
+    st.session_state.history_unsaved = 0  # events not yet written by save_snapshot
+
+    # part no -> deque of (rack, cell_no), oldest stocked cell on the left
+    st.session_state.fifo_index = defaultdict(deque)
+    if snapshot:
+        for pn, rk, cn in zip(snapshot["fifo_part"], snapshot["fifo_rack"], snapshot["fifo_cell"]):
+            # skip cells of racks that were not restored or no longer exist
+            if str(rk) in restored_racks and 1 <= cn <= RACK_SPACES[str(rk)]:
+                st.session_state.fifo_index[str(pn)].append((str(rk), int(cn)))
+
+def sync_snapshot():
+    """
+    Load the saved state if this session has none yet, or if another
+    session has saved since this one last loaded or saved. Returns True if
+    session state was (re)loaded. Call under snapshot_lock(), so a
+    compacting save cannot remove history files mid-read.
+    """
+    while True:
+        generation = snapshot_generation()
+        if "part_master_df" in st.session_state and generation == st.session_state.snapshot_generation:
+            return False
+        if generation < 0:
+            restore_state(None, [])
+            return True
+        try:
+            restore_state(*load_snapshot(generation))
+            return True
+        except FileNotFoundError:
+            # a history file compacted away under a reader means a newer
+            # generation was saved; read that one instead
+            if snapshot_generation() == generation:
+                raise
 
-if "history" not in st.session_state:
-    st.session_state.history = []
+# ----------------------------
+# Init session state
+# ----------------------------
+if "logged_in" not in st.session_state:
+    st.session_state.logged_in = False
+    st.session_state.user = None
+    st.session_state.role = None
+
+# also picks up stock changes saved by other sessions
+with snapshot_lock():
+    sync_snapshot()
 
 # ----------------------------
 # Utilities
 # ----------------------------
 def ts_now():
-    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    # same as strftime("%Y-%m-%d %H:%M:%S") without the locale-aware formatter
+    n = datetime.now()
+    return f"{n.year:04d}-{n.month:02d}-{n.day:02d} {n.hour:02d}:{n.minute:02d}:{n.second:02d}"
+
+def cell_total_weight(part_ids, qtys, part_weights):
+    """
+    Total weight (parts + packaging) per cell. Accepts same-shaped arrays
+    of part ids and quantities plus the per-id weight array, and returns a
+    float array of weights.
+    """
+    unit_wt = np.where(part_ids >= 0, part_weights[part_ids], 0.0)
+    return qtys * unit_wt + PACKAGING_WEIGHT * (qtys > 0)
+
+def part_nos_for(part_ids):
+    """
+    Map an array of part ids back to part numbers (None for empty cells).
+    """
+    # id -1 picks the trailing None
+    return np.array(st.session_state.part_ids + [None], dtype=object)[part_ids]
 
-def cell_total_weight(cell):
-    pn, qty = cell["Part No"], cell["Quantity"]
-    if qty > 0 and pn:
-        pm = st.session_state.part_master.get(pn, {})
-        return qty * pm.get("Weight", 0.0) + PACKAGING_WEIGHT
-    return 0.0
+def upsert_part(pn, weight, customer, tube_length):
+    """
+    Add or update a part master row, keeping the id/weight lookups in step.
+    """
+    if pn not in st.session_state.part_id:
+        bisect.insort(st.session_state.sorted_parts, pn)
+        st.session_state.part_id[pn] = len(st.session_state.part_ids)
+        st.session_state.part_ids.append(pn)
+    pm = st.session_state.part_master_df
+    pm.loc[pn] = [weight, customer, tube_length]
+    st.session_state.part_weights = pm["Weight"].to_numpy()
+    st.session_state.part_master_version += 1
+
+def show_notice(notice):
+    kind, message = notice
+    if kind == "success":
+        st.success(message)
+    else:
+        st.error(message)
 
 def add_history(action, rack, cell_no, part_no, qty, user, note=""):
-    st.session_state.history.insert(
-        0,
+    st.session_state.history.appendleft(
         {
             "Timestamp": ts_now(),
             "User": user,
@@ -90,6 +386,8 @@ def add_history(action, rack, cell_no, part_no, qty, user, note=""):
             "Note": note,
         },
     )
+    st.session_state.history_version += 1
+    st.session_state.history_unsaved += 1
 
 # ---- Helper functions to ensure consistent mapping ----
 def cell_no_to_indices(rack, cell_no):
@@ -97,69 +395,174 @@ def cell_no_to_indices(rack, cell_no):
     Convert 1-based cell_no (bottom-left = 1, left->right, bottom->top)
     to internal array indices (row_idx, col_idx) where array[0] is top row.
     """
-    cols = rack["cols"]
-    rows = rack["rows"]
     if cell_no < 1 or cell_no > rack["spaces"]:
         raise ValueError("cell_no out of range")
-    row_order_from_bottom = (cell_no - 1) // cols  # 0-based bottom row = 0
-    row_idx = rows - 1 - row_order_from_bottom    # flip because array[0] is top
-    col_idx = (cell_no - 1) % cols
-    return row_idx, col_idx
+    row_idx, col_idx = rack["cell_to_rc"][cell_no - 1]
+    return int(row_idx), int(col_idx)
 
 def indices_to_cell_no(rack, row_idx, col_idx):
     """
     Convert internal array indices back to 1-based cell_no (bottom-left = 1).
     """
-    cols = rack["cols"]
-    rows = rack["rows"]
-    if row_idx < 0 or row_idx >= rows or col_idx < 0 or col_idx >= cols:
+    if row_idx < 0 or row_idx >= rack["rows"] or col_idx < 0 or col_idx >= rack["cols"]:
         raise ValueError("indices out of range")
-    row_order_from_bottom = rows - 1 - row_idx
-    return row_order_from_bottom * cols + col_idx + 1
+    return int(rack["rc_to_cell"][row_idx, col_idx])
 
 def prepare_rack_grid_csv():
     """
     Prepare CSV rows in the same bottom-up cell order displayed to users.
     """
-    rows_out = []
-    for rn, rack in st.session_state.racks.items():
-        cell_no = 1
-        # iterate bottom row first to match displayed numbering
-        for row_order in range(rack["rows"]):
-            display_row = rack["rows"] - 1 - row_order
-            for col in range(rack["cols"]):
-                if cell_no > rack["spaces"]:
-                    break
-                c = rack["array"][display_row][col]
-                pm = st.session_state.part_master.get(c["Part No"], {}) if c["Part No"] else {}
-                rows_out.append(
-                    {
-                        "Rack": rn,
-                        "Cell": cell_no,
-                        "Part No": c["Part No"],
-                        "Customer": pm.get("Customer", ""),
-                        "Tube Length (mm)": pm.get("Tube Length", ""),
-                        "Quantity": c["Quantity"],
-                        "Total Weight (kg)": round(cell_total_weight(c), 2),
-                    }
-                )
-                cell_no += 1
-    return pd.DataFrame(rows_out)
-
-def prepare_part_master_csv_bytes():
-    df = pd.DataFrame.from_dict(st.session_state.part_master, orient="index").reset_index()
-    df = df.rename(columns={"index": "Part No"})
-    buf = io.StringIO()
-    df.to_csv(buf, index=False)
-    return buf.getvalue().encode("utf-8")
-
-def prepare_history_csv_bytes():
+    rack_map = st.session_state.racks
+    racks = rack_map.values()
+    # flip rows so the bottom row comes first, matching displayed numbering
+    part_ids = np.concatenate([np.ravel(r["part_id"][::-1])[: r["spaces"]] for r in racks])
+    qtys = np.concatenate([np.ravel(r["qty"][::-1])[: r["spaces"]] for r in racks])
+    # part master rows are in part id order, so details are gathered by id
+    pm_df = st.session_state.part_master_df
+    customers = np.append(pm_df["Customer"].to_numpy(dtype=object), "")  # id -1 picks the trailing ""
+    tubes = pd.array(pm_df["Tube Length"], dtype="Int64")
+    return pd.DataFrame(
+        {
+            "Rack": np.repeat(list(rack_map), [r["spaces"] for r in racks]),
+            "Cell": np.concatenate([np.arange(1, r["spaces"] + 1) for r in racks]),
+            "Part No": part_nos_for(part_ids),
+            "Customer": customers[part_ids],
+            "Tube Length (mm)": tubes.take(part_ids, allow_fill=True),
+            "Quantity": qtys,
+            "Total Weight (kg)": np.round(cell_total_weight(part_ids, qtys, st.session_state.part_weights), 2),
+        }
+    )
+
+def table_to_csv_bytes(table, chunk_rows=CSV_CHUNK_ROWS):
+    """
+    Write an Arrow table as UTF-8 CSV with pyarrow's C++ writer, chunk_rows
+    per batch, straight into a bytes buffer.
+    """
+    buf = io.BytesIO()
+    pacsv.write_csv(table, buf, pacsv.WriteOptions(batch_size=chunk_rows))
+    return buf.getvalue()
+
+def df_to_csv_bytes(df, chunk_rows=CSV_CHUNK_ROWS):
+    return table_to_csv_bytes(pa.Table.from_pandas(df, preserve_index=False), chunk_rows)
+
+# Download payloads below are cached per session and keyed on the version
+# counters of the state they export, since download_button data is built
+# eagerly on every run.
+@st.cache_data(max_entries=32, show_spinner=False)
+def grid_csv_bytes(session_id, state_version, part_master_version):
+    """
+    Grid CSV export, rebuilt only after a stock or part master change.
+    """
+    return df_to_csv_bytes(prepare_rack_grid_csv())
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def prepare_part_master_csv_bytes(session_id, part_master_version):
+    return df_to_csv_bytes(st.session_state.part_master_df.reset_index())
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def prepare_history_csv_bytes(session_id, history_version):
     if not st.session_state.history:
-        return "".encode("utf-8")
-    df = pd.DataFrame(st.session_state.history)
-    buf = io.StringIO()
-    df.to_csv(buf, index=False)
-    return buf.getvalue().encode("utf-8")
+        return b""
+    # Cell mixes ints and "-", so go through the typed history table
+    return table_to_csv_bytes(history_table())
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def history_display_frame(session_id, history_version, n_rows):
+    """
+    History Log table, newest first, limited to n_rows events (None = all).
+    Rebuilt only after add_history bumps history_version.
+    """
+    return pd.DataFrame(
+        list(itertools.islice(st.session_state.history, n_rows)),
+        columns=["Timestamp", "User", "Action", "Rack", "Cell", "Part No", "Quantity"],
+    )
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def prepare_history_feather_bytes(session_id, history_version):
+    """
+    History as a Feather (Arrow IPC) file, without going through pandas.
+    """
+    buf = pa.BufferOutputStream()
+    feather.write_feather(history_table(), buf)
+    return buf.getvalue().to_pybytes()
+
+_RACK_CSS = """
+<style>
+  .rack-wrap { overflow-x: auto; margin-bottom: 12px; }
+  .rack-table { border-collapse: collapse; font-family: Arial, sans-serif; margin:auto; }
+  .rack-table td { border: 1px solid #e6e6e6; padding: 10px; text-align: center; vertical-align: middle; min-width:140px; }
+  .cell-empty { background:#d9fdd3; color:#2e7d32; }
+  .cell-partial { background:#fff9c4; color:#9e7700; }
+  .cell-mid { background:#ffe0b2; color:#e65100; }
+  .cell-full { background:#ffcdd2; color:#b71c1c; }
+  .cell-content { font-size:14px; line-height:1.25; }
+</style>
+"""
+# collapse whitespace once at import; the block is re-sent on every Output run
+_RACK_CSS = " ".join(_RACK_CSS.split())
+
+# Fill-level classes: qty 0 -> empty, <50% -> partial, >=50% -> mid, full
+_FILL_BINS = np.array([1, CELL_CAPACITY / 2, CELL_CAPACITY])
+_FILL_CSS = np.array(["cell-empty", "cell-partial", "cell-mid", "cell-full"])
+
+# Cell markup for render_rack_html, filled in with str.format
+_RACK_CELL_TD = "<td class='{css}'>{content}</td>"
+_RACK_CELL_EMPTY = (
+    "<div class='cell-content'>"
+    "<div style='font-weight:700'>Cell {cell_no}</div>"
+    "<div style='margin-top:6px'>Empty</div>"
+    "</div>"
+)
+_RACK_CELL_STOCKED = (
+    "<div class='cell-content'>"
+    "<div style='font-weight:700'>Cell {cell_no}</div>"
+    "<div style='margin-top:6px'>{part_no}</div>"
+    "<div>Qty: {qty}</div>"
+    "<div style='font-size:12px;color:#333'>Wt: {wt} kg</div>"
+    "</div>"
+)
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def render_rack_html(session_id, rack_name, version, part_master_version, _rack, start_row, end_row):
+    """
+    Build the rack layout table for rows start_row..end_row-1, counted from
+    the bottom. Cached per session until the rack's version (or the part
+    master, for weights) changes.
+    """
+    ROWS = _rack["rows"]
+    COLS = _rack["cols"]
+    SPACES = _rack["spaces"]
+
+    parts = ["""
+    <div class="rack-wrap">
+    <table class="rack-table"><tbody>
+    """]
+
+    weights = cell_total_weight(_rack["part_id"], _rack["qty"], st.session_state.part_weights)
+    css_classes = _FILL_CSS[np.digitize(_rack["qty"], _FILL_BINS)]
+    for row_order in range(start_row, end_row):  # bottom row first (row_order 0 => bottom)
+        display_r = ROWS - 1 - row_order
+        cell_counter = row_order * COLS + 1
+        parts.append("<tr>")
+        for c in range(COLS):
+            if cell_counter <= SPACES:
+                css = css_classes[display_r, c]
+                if css == "cell-empty":
+                    content = _RACK_CELL_EMPTY.format(cell_no=cell_counter)
+                else:
+                    qty = int(_rack["qty"][display_r, c])
+                    part_no = st.session_state.part_ids[_rack["part_id"][display_r, c]]
+                    wt = round(float(weights[display_r, c]), 2)
+                    content = _RACK_CELL_STOCKED.format(cell_no=cell_counter, part_no=part_no, qty=qty, wt=wt)
+            else:
+                css = "cell-empty"
+                content = ""
+            parts.append(_RACK_CELL_TD.format(css=css, content=content))
+            cell_counter += 1
+        parts.append("</tr>")
+
+    parts.append("</tbody></table></div>")
+    return "".join(parts)
 
 # ----------------------------
 # Sidebar - Authentication + Navigation
@@ -218,14 +621,15 @@ with col1:
     st.title("Multi-Rack FG Stock Board")
     st.caption(f"Signed in as {st.session_state.user} ({role})")
 with col2:
-    total_qty = sum(c["Quantity"] for r in st.session_state.racks.values() for row in r["array"] for c in row)
-    st.metric("Total Qty", f"{total_qty}")
+    st.metric("Total Qty", f"{st.session_state.total_qty}")
 
 # ----------------------------
 # MASTER Tab
 # ----------------------------
-if page == "Master" and can_master:
+@st.fragment
+def render_master_tab():
     st.subheader("Part Master")
+    notice = st.session_state.pop("master_notice", None)
     with st.form("part_master_form"):
         pn = st.text_input("Part No").strip()
         wt = st.number_input("Weight (kg)", min_value=0.0, step=0.01, format="%.2f")
@@ -233,61 +637,120 @@ if page == "Master" and can_master:
         tube = st.number_input("Tube Length (mm)", min_value=0, step=1)
         if st.form_submit_button("Add / Update Part"):
             if pn:
-                st.session_state.part_master[pn] = {"Weight": wt, "Customer": cust, "Tube Length": int(tube)}
-                add_history("Master Update", "-", "-", pn, 0, st.session_state.user)
-                st.success(f"Updated master for {pn}")
+                with snapshot_lock():
+                    reloaded = sync_snapshot()
+                    upsert_part(pn, wt, cust, int(tube))
+                    add_history("Master Update", "-", "-", pn, 0, st.session_state.user)
+                    result = save_change(f"Updated master for {pn}")
+                # newer state loaded here, or by a failed save's rollback, can
+                # change the header total outside this fragment
+                if reloaded or result[0] == "error":
+                    st.session_state.master_notice = result
+                    st.rerun()
+                show_notice(result)
+        elif notice:
+            show_notice(notice)
+
+    st.dataframe(st.session_state.part_master_df)
+    st.download_button(
+        "⬇️ Download Part Master CSV",
+        data=prepare_part_master_csv_bytes(st.session_state.session_id, st.session_state.part_master_version),
+        file_name="part_master.csv",
+        mime="text/csv",
+    )
 
-    st.dataframe(pd.DataFrame.from_dict(st.session_state.part_master, orient="index").reset_index().rename(columns={"index":"Part No"}))
-    st.download_button("⬇️ Download Part Master CSV", data=prepare_part_master_csv_bytes(), file_name="part_master.csv", mime="text/csv")
+if page == "Master" and can_master:
+    render_master_tab()
 
 # ----------------------------
 # INPUT Tab
 # ----------------------------
-if page == "Input" and can_input:
+@st.fragment
+def render_input_tab():
     st.subheader("Stock Input")
     rack_ui = st.selectbox("Rack", options=list(st.session_state.racks.keys()))
     rack_data = st.session_state.racks[rack_ui]
     SPACES = rack_data["spaces"]
 
+    # stock changes rerun the whole app (header total); the notice survives via session_state
+    notice = st.session_state.pop("stock_notice", None)
     with st.form("stock_form", clear_on_submit=True):
         cell_no = st.number_input("Cell No", min_value=1, max_value=SPACES, value=1, step=1)
-        part_no = st.selectbox("Part No", options=sorted(st.session_state.part_master.keys()))
+        part_no = st.selectbox("Part No", options=st.session_state.sorted_parts)
         qty = st.number_input("Quantity", min_value=1, step=1)
         action = st.radio("Action", ["Add", "Subtract"], horizontal=True)
         if st.form_submit_button("Apply"):
-            try:
-                row_idx, col_idx = cell_no_to_indices(rack_data, cell_no)
-            except ValueError:
-                st.error("Invalid cell number")
-            else:
-                cell = rack_data["array"][row_idx][col_idx]
-                if action == "Add":
-                    if cell["Part No"] in (None, part_no):
-                        if cell["Quantity"] + qty <= CELL_CAPACITY:
-                            cell["Part No"] = part_no
-                            cell["Quantity"] += qty
-                            add_history("Add", rack_ui, cell_no, part_no, qty, st.session_state.user)
-                            st.success(f"Added {qty} of {part_no} at {rack_ui} Cell {cell_no}")
+            # apply on top of whatever other sessions saved since this one synced
+            with snapshot_lock():
+                rerun = sync_snapshot()
+                rack_data = st.session_state.racks[rack_ui]
+                try:
+                    row_idx, col_idx = cell_no_to_indices(rack_data, cell_no)
+                except ValueError:
+                    result = ("error", "Invalid cell number")
+                else:
+                    pid = st.session_state.part_id[part_no]
+                    cell_pid = rack_data["part_id"][row_idx, col_idx]
+                    cell_qty = rack_data["qty"][row_idx, col_idx]
+                    if action == "Add":
+                        if cell_pid in (-1, pid):
+                            if cell_qty + qty <= CELL_CAPACITY:
+                                rack_data["part_id"][row_idx, col_idx] = pid
+                                rack_data["qty"][row_idx, col_idx] += qty
+                                st.session_state.total_qty += qty
+                                st.session_state.rack_versions[rack_ui] += 1
+                                st.session_state.state_version += 1
+                                if cell_pid == -1:
+                                    st.session_state.fifo_index[part_no].append((rack_ui, cell_no))
+                                add_history("Add", rack_ui, cell_no, part_no, qty, st.session_state.user)
+                                result = save_change(f"Added {qty} of {part_no} at {rack_ui} Cell {cell_no}")
+                                rerun = True
+                            else:
+                                result = ("error", "Exceeds cell capacity")
                         else:
-                            st.error("Exceeds cell capacity")
-                    else:
-                        st.error("Cell already has a different part")
-                else:  # Subtract
-                    if cell["Part No"] == part_no and cell["Quantity"] >= qty:
-                        cell["Quantity"] -= qty
-                        if cell["Quantity"] == 0:
-                            cell["Part No"] = None
-                        add_history("Subtract", rack_ui, cell_no, part_no, qty, st.session_state.user)
-                        st.success(f"Subtracted {qty} from {rack_ui} Cell {cell_no}")
-                    else:
-                        st.error("Mismatch or insufficient stock")
-
-    st.download_button("⬇️ Download Grid CSV", data=prepare_rack_grid_csv().to_csv(index=False).encode("utf-8"), file_name="grid.csv", mime="text/csv")
+                            result = ("error", "Cell already has a different part")
+                    else:  # Subtract
+                        if cell_pid == pid and cell_qty >= qty:
+                            rack_data["qty"][row_idx, col_idx] -= qty
+                            st.session_state.total_qty -= qty
+                            st.session_state.rack_versions[rack_ui] += 1
+                            st.session_state.state_version += 1
+                            if rack_data["qty"][row_idx, col_idx] == 0:
+                                rack_data["part_id"][row_idx, col_idx] = -1
+                                fifo_q = st.session_state.fifo_index.get(part_no, deque())
+                                if (rack_ui, cell_no) in fifo_q:
+                                    fifo_q.remove((rack_ui, cell_no))
+                            add_history("Subtract", rack_ui, cell_no, part_no, qty, st.session_state.user)
+                            result = save_change(f"Subtracted {qty} from {rack_ui} Cell {cell_no}")
+                            rerun = True
+                        else:
+                            result = ("error", "Mismatch or insufficient stock")
+            # a save or a reload of newer state changes the header total
+            # outside this fragment, so rerun the whole app
+            if rerun:
+                st.session_state.stock_notice = result
+                st.rerun()
+            show_notice(result)
+        elif notice:
+            show_notice(notice)
+
+    st.download_button(
+        "⬇️ Download Grid CSV",
+        data=grid_csv_bytes(st.session_state.session_id, st.session_state.state_version, st.session_state.part_master_version),
+        file_name="grid.csv",
+        mime="text/csv",
+    )
+
+if page == "Input" and can_input:
+    render_input_tab()
 
 # ----------------------------
 # OUTPUT Tab
 # ----------------------------
-if page == "Output" and can_output:
+# Each panel is its own fragment, so a FIFO search or history toggle
+# reruns only that panel and not the rack layout
+@st.fragment
+def render_rack_panel():
     st.subheader("Rack Overview")
     out_rack = st.selectbox("Select Rack to View", options=list(st.session_state.racks.keys()))
     rack = st.session_state.racks[out_rack]
@@ -304,100 +767,93 @@ if page == "Output" and can_output:
 
     # --- Rack Layout (no headers) ---
     st.markdown("### Rack Layout")
-    ROWS = rack["rows"]
-    COLS = rack["cols"]
-    SPACES = rack["spaces"]
-
-    html = """
-    <style>
-      .rack-wrap { overflow-x: auto; margin-bottom: 12px; }
-      .rack-table { border-collapse: collapse; font-family: Arial, sans-serif; margin:auto; }
-      .rack-table td { border: 1px solid #e6e6e6; padding: 10px; text-align: center; vertical-align: middle; min-width:140px; }
-      .cell-empty { background:#d9fdd3; color:#2e7d32; }
-      .cell-partial { background:#fff9c4; color:#9e7700; }
-      .cell-mid { background:#ffe0b2; color:#e65100; }
-      .cell-full { background:#ffcdd2; color:#b71c1c; }
-      .cell-content { font-size:14px; line-height:1.25; }
-    </style>
-    <div class="rack-wrap">
-    <table class="rack-table"><tbody>
-    """
-
-    cell_counter = 1
-    for row_order in range(ROWS):  # bottom row first (row_order 0 => bottom)
-        display_r = ROWS - 1 - row_order
-        html += "<tr>"
-        for c in range(COLS):
-            if cell_counter <= SPACES:
-                cell_obj = rack["array"][display_r][c]
-                qty = cell_obj["Quantity"]
-                part_no = cell_obj.get("Part No")
-
-                if not part_no or qty == 0:
-                    css = "cell-empty"
-                    content = (
-                        f"<div class='cell-content'>"
-                        f"<div style='font-weight:700'>Cell {cell_counter}</div>"
-                        f"<div style='margin-top:6px'>Empty</div>"
-                        f"</div>"
-                    )
-                else:
-                    fill_ratio = qty / CELL_CAPACITY
-                    if fill_ratio >= 1.0:
-                        css = "cell-full"
-                    elif fill_ratio >= 0.5:
-                        css = "cell-mid"
-                    else:
-                        css = "cell-partial"
-                    wt = round(cell_total_weight(cell_obj), 2)
-                    content = (
-                        f"<div class='cell-content'>"
-                        f"<div style='font-weight:700'>Cell {cell_counter}</div>"
-                        f"<div style='margin-top:6px'>{part_no}</div>"
-                        f"<div>Qty: {qty}</div>"
-                        f"<div style='font-size:12px;color:#333'>Wt: {wt} kg</div>"
-                        f"</div>"
-                    )
-            else:
-                css = "cell-empty"
-                content = ""
-            html += f"<td class='{css}'>{content}</td>"
-            cell_counter += 1
-        html += "</tr>"
-
-    html += "</tbody></table></div>"
+    # Emitted on every run: Streamlit drops elements a rerun doesn't re-emit,
+    # so gating this on a session flag would lose the styles after one click
+    st.markdown(_RACK_CSS, unsafe_allow_html=True)
+    ROWS, COLS, SPACES = rack["rows"], rack["cols"], rack["spaces"]
+    rows_per_page = max(1, RACK_PAGE_CELLS // COLS)
+    row_pages = [(s, min(s + rows_per_page, ROWS)) for s in range(0, ROWS, rows_per_page)]
+    page_idx = 0
+    if len(row_pages) > 1:
+        # only the selected band of rows is built and sent to the browser
+        page_idx = st.radio(
+            "Cells",
+            range(len(row_pages)),
+            format_func=lambda i: f"{row_pages[i][0] * COLS + 1}–{min(row_pages[i][1] * COLS, SPACES)}",
+            horizontal=True,
+        )
+    start_row, end_row = row_pages[page_idx]
+    html = render_rack_html(
+        st.session_state.session_id,
+        out_rack,
+        st.session_state.rack_versions[out_rack],
+        st.session_state.part_master_version,
+        rack,
+        start_row,
+        end_row,
+    )
     st.markdown(html, unsafe_allow_html=True)
 
+@st.fragment
+def render_fifo_panel():
     # --- FIFO Finder (oldest Add event that still has stock) ---
     st.subheader("FIFO Part Finder")
     search_part = st.text_input("Part No")
     if st.button("Find FIFO Cell"):
         fifo = None
-        # history[0] is most recent, so reversed() gives oldest->newest
-        for ev in reversed(st.session_state.history):
-            if ev["Action"] == "Add" and ev["Part No"] == search_part:
-                rk, cell_no = ev["Rack"], ev["Cell"]
-                rack_check = st.session_state.racks.get(rk)
+        pid = st.session_state.part_id.get(search_part)
+        # .get so searching for an unknown part doesn't add an empty entry
+        fifo_q = st.session_state.fifo_index.get(search_part, deque())
+        # the head is the oldest stocked cell; drop any entry that went stale
+        while fifo_q:
+            rk, cell_no = fifo_q[0]
+            rack_check = st.session_state.racks.get(rk)
+            try:
                 if not rack_check:
-                    continue
-                try:
-                    row_idx, col_idx = cell_no_to_indices(rack_check, cell_no)
-                except ValueError:
-                    continue
-                cell = rack_check["array"][row_idx][col_idx]
-                if cell["Part No"] == search_part and cell["Quantity"] > 0:
-                    fifo = {"Rack": rk, "Cell": cell_no, "Qty": cell["Quantity"]}
-                    break
+                    raise ValueError("unknown rack")
+                row_idx, col_idx = cell_no_to_indices(rack_check, cell_no)
+            except ValueError:
+                fifo_q.popleft()
+                continue
+            cell_qty = int(rack_check["qty"][row_idx, col_idx])
+            if rack_check["part_id"][row_idx, col_idx] == pid and cell_qty > 0:
+                fifo = {"Rack": rk, "Cell": cell_no, "Qty": cell_qty}
+                break
+            fifo_q.popleft()
         if fifo:
             st.success(f"FIFO pick: Rack {fifo['Rack']} Cell {fifo['Cell']} (Qty: {fifo['Qty']})")
         else:
             st.warning("No FIFO candidate found")
 
+@st.fragment
+def render_history_panel():
     # --- History Log ---
     st.subheader("History Log")
     if st.session_state.history:
-        df_hist = pd.DataFrame(st.session_state.history)[["Timestamp","User","Action","Rack","Cell","Part No","Quantity"]]
-        st.dataframe(df_hist)
-        st.download_button("⬇️ Download History CSV", data=prepare_history_csv_bytes(), file_name="history.csv", mime="text/csv")
+        n_events = len(st.session_state.history)
+        n_rows = None
+        if n_events > HISTORY_DISPLAY_ROWS and not st.checkbox(f"Show all history ({n_events} events)"):
+            n_rows = HISTORY_DISPLAY_ROWS
+        st.dataframe(history_display_frame(st.session_state.session_id, st.session_state.history_version, n_rows))
+        st.download_button(
+            "⬇️ Download History CSV",
+            data=prepare_history_csv_bytes(st.session_state.session_id, st.session_state.history_version),
+            file_name="history.csv",
+            mime="text/csv",
+        )
+        st.download_button(
+            "⬇️ Download History (Feather)",
+            data=prepare_history_feather_bytes(st.session_state.session_id, st.session_state.history_version),
+            file_name="history.feather",
+            mime="application/octet-stream",
+        )
     else:
         st.info("No history yet")
+
+def render_output_tab():
+    render_rack_panel()
+    render_fifo_panel()
+    render_history_panel()
+
+if page == "Output" and can_output:
+    render_output_tab()
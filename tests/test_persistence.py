@@ -0,0 +1,115 @@
+"""
+Scripted multi-session checks for the shared snapshot: merge-on-write,
+history compaction and failed saves. Run with `python -m pytest`.
+"""
+import os
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.feather as feather
+import pytest
+import streamlit as st
+from streamlit.testing.v1 import AppTest
+
+APP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "part_table_app.py")
+HISTORY_MAXLEN = 10_000
+HISTORY_COMPACT_SEGMENTS = 256
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    path = tmp_path / "stock_data"
+    monkeypatch.setenv("STOCK_BOARD_DATA_DIR", str(path))
+    # snapshot loads are cached per generation, which restarts at 0 in each test
+    st.cache_data.clear()
+    st.cache_resource.clear()
+    return path
+
+
+def open_session(page=None):
+    at = AppTest.from_file(APP, default_timeout=30)
+    at.run()
+    at.sidebar.text_input[0].input("Vishal")
+    at.sidebar.text_input[1].input("master123")
+    at.sidebar.button[0].click().run()
+    if page:
+        at.sidebar.radio[0].set_value(page).run()
+    assert not at.exception
+    return at
+
+
+def stock(at, cell_no, qty, action="Add"):
+    at.number_input[0].set_value(cell_no)
+    at.number_input[1].set_value(qty)
+    at.main.radio[0].set_value(action)
+    at.button[0].click().run()
+    assert not at.exception
+
+
+def test_stale_session_saves_on_top_of_newer_state(data_dir):
+    a = open_session("Master")
+    b = open_session("Input")  # loaded before a saves anything
+
+    a.text_input[0].input("X1")
+    a.number_input[0].set_value(1.5)
+    a.text_input[1].input("ACME")
+    a.number_input[1].set_value(900)
+    a.button[0].click().run()
+    a.sidebar.radio[0].set_value("Input").run()
+    stock(a, 1, 2)
+
+    stock(b, 2, 3)
+
+    c = open_session()
+    assert "X1" in c.session_state.part_master_df.index
+    assert c.session_state.total_qty == 5
+    history = [(ev["Action"], ev["Cell"]) for ev in c.session_state.history]
+    assert history == [("Add", 2), ("Add", 1), ("Master Update", "-")]
+
+
+def test_compaction_keeps_newest_events(data_dir):
+    a = open_session("Input")
+    stock(a, 1, 1)
+
+    # pad the log to just below the compaction point with 40 events per file
+    schema = feather.read_table(data_dir / "history" / "00000000.arrow").schema
+    padded = []
+    for g in range(1, HISTORY_COMPACT_SEGMENTS):
+        stamps = [f"pad-{g:03d}-{i:02d}" for i in range(39, -1, -1)]  # newest first
+        cols = {name: [""] * len(stamps) for name in schema.names}
+        cols.update(Timestamp=stamps, Action=["Add"] * len(stamps), Quantity=[0] * len(stamps))
+        feather.write_feather(pa.Table.from_pydict(cols, schema=schema), str(data_dir / "history" / f"{g:08d}.arrow"))
+        padded = stamps + padded
+    with np.load(data_dir / "racks.npz") as npz:
+        arrays = {k: npz[k] for k in npz.files}
+    arrays["generation"] = np.int64(HISTORY_COMPACT_SEGMENTS - 1)
+    np.savez_compressed(data_dir / "racks.npz", **arrays)
+
+    b = open_session("Input")
+    assert len(b.session_state.history) == HISTORY_MAXLEN
+    stock(b, 2, 1)  # this save compacts the log
+
+    assert os.listdir(data_dir / "history") == [f"{HISTORY_COMPACT_SEGMENTS:08d}.arrow"]
+    log = feather.read_table(data_dir / "history" / f"{HISTORY_COMPACT_SEGMENTS:08d}.arrow").to_pylist()
+    assert len(log) == HISTORY_MAXLEN
+    assert log[0]["Cell"] == "2"
+    assert [ev["Timestamp"] for ev in log[1:]] == padded[: HISTORY_MAXLEN - 1]
+
+    c = open_session()
+    assert len(c.session_state.history) == HISTORY_MAXLEN
+    assert c.session_state.history[0]["Cell"] == 2
+
+
+def test_failed_save_rolls_back(tmp_path, monkeypatch):
+    blocker = tmp_path / "not_a_dir"
+    blocker.write_text("")
+    monkeypatch.setenv("STOCK_BOARD_DATA_DIR", str(blocker / "stock_data"))
+    st.cache_data.clear()
+    st.cache_resource.clear()
+
+    a = open_session("Input")
+    stock(a, 1, 2)
+
+    assert [e.value for e in a.error][0].startswith("Could not save the change")
+    assert a.session_state.total_qty == 0
+    assert not a.session_state.history